@@ -666,9 +666,12 @@ class Pill(models.Model):
 
             # Layer 2: DB-level row lock inside a transaction
             with transaction.atomic():
+                # Only the pill row is locked; user/address ride along so
+                # create_order doesn't lazy-load them.
                 current_pill = (
                     Pill.objects
-                    .select_for_update()
+                    .select_related('user', 'pilladdress')
+                    .select_for_update(of=('self',))
                     .get(pk=self.pk)
                 )
 
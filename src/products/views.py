@@ -1770,7 +1770,10 @@ def resend_khazenly_orders_view(request):
                 khazenly_order_id__isnull=True
             )
         
-        pills = list(pills_query.order_by('date_added'))
+        # User and address are read for every pill (summary + Khazenly payload)
+        pills = list(
+            pills_query.select_related('user', 'pilladdress').order_by('date_added')
+        )
         
         if not pills:
             return Response({
@@ -1,16 +1,171 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import logging
 import re
-import copy
+import threading
+import time
 import unicodedata
 from django.conf import settings
 from django.core.cache import cache
-from datetime import datetime, timedelta
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import OuterRef, Subquery
 from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+from products.models import GOVERNMENT_CHOICES, Discount
 
 logger = logging.getLogger(__name__)
 
+# Access tokens live 2h; the shared cache entry expires after 1h50m so a
+# cache hit is always usable. The in-process copy is dropped a little
+# earlier than its own deadline so we never send a token mid-expiry.
+_TOKEN_LIFETIME_SECONDS = 7200
+_TOKEN_TTL_SECONDS = 6600
+# When the token response carries expires_in, keep the same 10m of slack
+# (or half the lifetime, for tokens shorter than 20m).
+_TOKEN_EXPIRY_SLACK_SECONDS = 600
+_TOKEN_REFRESH_MARGIN_SECONDS = 60
+# A token read back from the cache has an unknown remaining lifetime beyond
+# the slack stored with it, so it is only trusted in-process for a few
+# minutes, and never for longer than that slack.
+_TOKEN_LOCAL_RECHECK_SECONDS = 300
+# Circuit breaker: after this many consecutive Khazenly API failures (network
+# errors or 5xx from CreateOrder, GetOrder or order status, counted over a
+# 10 minute window) stop calling Khazenly for a while instead of tying up a
+# worker on the timeouts for every checkout.
+_CIRCUIT_FAILURE_THRESHOLD = 5
+_CIRCUIT_FAILURE_WINDOW_SECONDS = 600
+_CIRCUIT_RESET_SECONDS = 30
+_CIRCUIT_OPEN_ERROR = 'Khazenly temporarily unavailable. Please try again shortly.'
+# Successful order-status lookups are reused for this long.
+_ORDER_STATUS_CACHE_SECONDS = 60
+
+
+def _build_session(max_retries):
+    """
+    One pooled session per process: keeps the TCP+TLS connection to
+    Khazenly alive between calls instead of handshaking again every time.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=max_retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept': 'application/json'})
+    return session
+
+
+# API calls: gateway errors are retried with backoff for idempotent requests
+# only; urllib3 never retries POST by default, so CreateOrder is sent once.
+# Read timeouts are never retried: a stalled GetOrder runs inside the pill's
+# select_for_update transaction and must not hold the row for 4x30s. Connect
+# errors aren't either, so an unreachable host fails fast and goes straight
+# to the circuit breaker.
+_session = _build_session(Retry(
+    total=3,
+    connect=0,
+    read=0,
+    backoff_factor=0.3,
+    status_forcelist=(502, 503, 504),
+    raise_on_status=False,
+))
+
+# Token refresh: the refresh_token grant has no side effects, so unlike
+# CreateOrder it is safe to resend when the gateway is busy or rate limiting.
+# It gets its own session (and so its own keep-alive pool). Only connect
+# errors and retryable statuses are retried - never read timeouts - and
+# Retry-After is ignored, so a refresh is bounded by
+# _TOKEN_REFRESH_MAX_SECONDS below.
+_TOKEN_RETRIES = 2
+_token_session = _build_session(Retry(
+    total=_TOKEN_RETRIES,
+    read=0,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset({'POST'}),
+    respect_retry_after_header=False,
+    raise_on_status=False,
+))
+
+# (connect, read) timeouts: on the API session (no connect retries) an
+# unreachable host fails in ~3s instead of holding the worker for the full
+# read timeout; the token session retries connects, see below.
+_CONNECT_TIMEOUT_SECONDS = 3.05
+_DEFAULT_TIMEOUT = (_CONNECT_TIMEOUT_SECONDS, 30)
+_TOKEN_TIMEOUT = (_CONNECT_TIMEOUT_SECONDS, 10)
+# Worst case for one refresh: every attempt uses its full timeouts, plus the
+# 0s and 1s backoff sleeps between the three attempts. Workers that find the
+# refresh lock taken poll for this long and then give up (no token) rather
+# than refreshing without the lock; the lock outlives it so it can't expire
+# under a refresh that is still retrying.
+_TOKEN_REFRESH_MAX_SECONDS = (_TOKEN_RETRIES + 1) * sum(_TOKEN_TIMEOUT) + 1
+_TOKEN_REFRESH_LOCK_SECONDS = int(_TOKEN_REFRESH_MAX_SECONDS) + 5
+_CREATE_ORDER_TIMEOUT = (_CONNECT_TIMEOUT_SECONDS, 60)
+
+# Government code -> display name, built once from the model choices.
+_GOVERNMENT_NAMES = dict(GOVERNMENT_CHOICES)
+# City names Khazenly accepts.
+_SUPPORTED_CITIES = (
+    'Alexandria', 'Assiut', 'Aswan', 'Bani-Sweif', 'Behera', 'Cairo',
+    'Dakahleya', 'Damietta', 'Fayoum', 'Giza', 'Hurghada', 'Ismailia',
+    'Luxor', 'Mahalla', 'Mansoura', 'Marsa Matrouh', 'Menya', 'Monefeya',
+    'North Coast', 'Port-Said', 'Qalyubia', 'Qena', 'Red Sea', 'Sharkeya',
+    'Sohag', 'Suez', 'Tanta', 'Zagazig', 'Gharbeya', 'Kafr El Sheikh',
+    'Al-Wadi Al-Gadid', 'Sharm El Sheikh', 'North Sinai', 'South Sinai',
+)
+_SUPPORTED_CITY_SET = frozenset(_SUPPORTED_CITIES)
+# Government code -> Khazenly city name.
+_GOVERNMENT_TO_CITY = {
+    '1': 'Cairo', '2': 'Alexandria', '3': 'Kafr El Sheikh',
+    '4': 'Dakahleya', '5': 'Sharkeya', '6': 'Gharbeya',
+    '7': 'Monefeya', '8': 'Qalyubia', '9': 'Giza',
+    '10': 'Bani-Sweif', '11': 'Fayoum', '12': 'Menya',
+    '13': 'Assiut', '14': 'Sohag', '15': 'Qena',
+    '16': 'Luxor', '17': 'Aswan', '18': 'Red Sea',
+    '19': 'Behera', '20': 'Ismailia', '21': 'Suez',
+    '22': 'Port-Said', '23': 'Damietta', '24': 'Marsa Matrouh',
+    '25': 'Al-Wadi Al-Gadid', '26': 'North Sinai', '27': 'South Sinai',
+}
+
+# Sanitization patterns, compiled once at import.
+_INVISIBLE_RE = re.compile(r'[\u200b-\u200f\u202a-\u202e\u2060-\u2064\ufeff\ufffe]+')
+_WHITESPACE_RE = re.compile(r'\s+')
+_SURROGATE_RE = re.compile('[\ud800-\udfff]')
+# str.translate table deleting C0 control chars except \t, \n, \r.
+_CONTROL_CHARS = dict.fromkeys(c for c in range(32) if c not in (9, 10, 13))
+_PHONE_JUNK_RE = re.compile(r'[^\d+]')
+# Same as _PHONE_JUNK_RE for ASCII input: delete everything but 0-9 and '+'.
+_PHONE_ASCII_JUNK = dict.fromkeys(c for c in range(128) if chr(c) not in '0123456789+')
+# A complete Egyptian mobile number on an operator prefix Khazenly accepts
+# (010 / 011 / 012 / 015).
+_EGY_MOBILE_RE = re.compile(r'01[0125]\d{8}')
+# The junk-stripping patterns also swallow surrounding whitespace, so one
+# sub(' ') both removes disallowed characters and collapses spacing.
+_ITEM_NAME_JUNK_RE = re.compile(
+    r'(?:[^\w\s\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF'
+    r'\uFB50-\uFDFF\uFE70-\uFEFF.,\-()]|\s)+'
+)
+# Stricter clean used when Khazenly rejects the customer record.
+_STRICT_JUNK_RE = re.compile(r'(?:[^\w\s\u0600-\u06FF\u0750-\u077F.,\-()]|\s)+')
+# Characters flagged as "special" by diagnose_customer_data.
+_SPECIAL_CHARS_RE = re.compile(r'[^\w\s\-.,()]+')
+
+# Logical-error classification for CreateOrder responses.  One regex scan
+# finds every marker; each named group maps to a handler, and the mapping
+# order is the priority order when a message matches more than one.
+_LOGICAL_ERROR_RE = re.compile(
+    r'(?P<corrupted>(?i:corrupted customer data|wrong code|corpted))'
+    r'|(?P<duplicate>DUPLICATES_DETECTED|Consignee Code already exists)'
+    r'|(?P<too_long>STRING_TOO_LONG)'
+    r'|(?P<missing>REQUIRED_FIELD_MISSING)'
+)
+_LOGICAL_ERROR_HANDLERS = {
+    'corrupted': '_handle_corrupted_customer',
+    'duplicate': '_handle_duplicate_customer',
+    'too_long': '_handle_string_too_long',
+    'missing': '_handle_required_field_missing',
+}
+
 
 class KhazenlyService:
     def __init__(self):
@@ -22,9 +177,25 @@ class KhazenlyService:
         self.refresh_token = settings.KHAZENLY_REFRESH_TOKEN
         self.consignee_prefix = getattr(settings, 'KHAZENLY_CONSIGNEE_PREFIX', 'BOOKIFAY')
 
+        # Endpoints (base_url is fixed per instance)
+        self.token_url = f"{self.base_url}/selfservice/services/oauth2/token"
+        self.create_order_url = f"{self.base_url}/services/apexrest/api/CreateOrder"
+        self.get_order_url = f"{self.base_url}/services/apexrest/api/GetOrder"
+        self.order_status_url_prefix = (
+            f"{self.base_url}/services/apexrest/ExternalIntegrationWebService/orders/"
+        )
+
         # Cache keys
         self.access_token_cache_key = 'khazenly_access_token'
-        self.token_expiry_cache_key = 'khazenly_token_expiry'
+        self.refresh_lock_cache_key = 'khazenly_token_refresh_lock'
+        self.failure_count_cache_key = 'khazenly_fail_count'
+        self.circuit_open_cache_key = 'khazenly_circuit_open'
+
+        # In-process token memo (the module-level instance is shared by
+        # every request in the worker, so this skips the cache round-trips).
+        self._token = None
+        self._token_expires_at = 0.0
+        self._token_lock = threading.Lock()
 
     # ------------------------------------------------------------------
     #  Authentication
@@ -32,55 +203,127 @@ class KhazenlyService:
 
     def get_access_token(self):
         """Get valid access token, refresh if needed."""
-        try:
-            cached_token = cache.get(self.access_token_cache_key)
-            token_expiry = cache.get(self.token_expiry_cache_key)
+        if self._token and time.monotonic() < self._token_expires_at:
+            return self._token
 
-            if cached_token and token_expiry:
-                if datetime.now() < token_expiry:
-                    return cached_token
+        with self._token_lock:
+            # Another thread may have refreshed while we waited.
+            if self._token and time.monotonic() < self._token_expires_at:
+                return self._token
+            return self._fetch_access_token()
 
-            logger.info("Refreshing Khazenly access token...")
+    def _remember_token(self, access_token, ttl_seconds):
+        self._token = access_token
+        self._token_expires_at = time.monotonic() + ttl_seconds - _TOKEN_REFRESH_MARGIN_SECONDS
 
-            token_url = f"{self.base_url}/selfservice/services/oauth2/token"
+    def _read_cached_token(self):
+        """
+        Token from the shared cache, else None.
 
-            token_data = {
-                'grant_type': 'refresh_token',
-                'client_id': self.client_id,
-                'client_secret': self.client_secret,
-                'refresh_token': self.refresh_token,
-            }
+        The entry is (token, slack): the token is still valid for at least
+        slack seconds after the entry expires, which bounds the memo.
+        """
+        entry = cache.get(self.access_token_cache_key)
+        if not entry:
+            return None
+        if isinstance(entry, str):
+            # Entry written before the slack was stored (fixed 2h tokens)
+            entry = (entry, _TOKEN_EXPIRY_SLACK_SECONDS)
+        token, slack = entry
+        self._remember_token(token, min(_TOKEN_LOCAL_RECHECK_SECONDS, slack))
+        return token
+
+    def _fetch_access_token(self):
+        """
+        Read the token from the shared cache, or refresh it from Khazenly.
 
-            headers = {
-                'Content-Type': 'application/x-www-form-urlencoded',
-                'Accept': 'application/json',
-            }
+        cache.add() is used as a cross-worker mutex so that only one worker
+        hits the OAuth endpoint when the token expires.  The others poll for
+        the token it publishes, taking the lock themselves if it is released
+        without one, and never refresh unlocked: after
+        _TOKEN_REFRESH_MAX_SECONDS they give up and return None.
+        """
+        try:
+            deadline = time.monotonic() + _TOKEN_REFRESH_MAX_SECONDS
+            while True:
+                token = self._read_cached_token()
+                if token:
+                    return token
+
+                if cache.add(self.refresh_lock_cache_key, '1',
+                             timeout=_TOKEN_REFRESH_LOCK_SECONDS):
+                    try:
+                        return self._refresh_access_token()
+                    finally:
+                        cache.delete(self.refresh_lock_cache_key)
+
+                if time.monotonic() >= deadline:
+                    logger.warning("Timed out waiting for another worker's Khazenly token refresh")
+                    return None
+                time.sleep(0.2)
+
+        except Exception as e:
+            logger.error(f"Exception getting access token: {e}")
+            return None
 
-            response = requests.post(token_url, data=token_data, headers=headers, timeout=30)
+    def _refresh_access_token(self):
+        """POST the refresh_token grant and publish the new token."""
+        logger.info("Refreshing Khazenly access token...")
 
-            logger.info(f"Token response status: {response.status_code}")
+        token_data = {
+            'grant_type': 'refresh_token',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'refresh_token': self.refresh_token,
+        }
 
-            if response.status_code == 200:
-                token_response = response.json()
-                access_token = token_response.get('access_token')
-
-                if access_token:
-                    expiry_time = datetime.now() + timedelta(hours=1, minutes=50)
-                    cache.set(self.access_token_cache_key, access_token, timeout=6600)
-                    cache.set(self.token_expiry_cache_key, expiry_time, timeout=6600)
-                    logger.info("Access token refreshed and cached successfully")
-                    return access_token
-                else:
-                    logger.error("No access_token in response")
-                    return None
+        # data= form-encodes the body and sets its Content-Type
+        response = _token_session.post(self.token_url, data=token_data, timeout=_TOKEN_TIMEOUT)
+
+        logger.debug("Token response status: %s", response.status_code)
+
+        if response.status_code == 200:
+            token_response = response.json()
+            access_token = token_response.get('access_token')
+
+            if access_token:
+                lifetime = self._token_lifetime(token_response.get('expires_in'))
+                ttl = self._token_ttl(lifetime)
+                cache.set(
+                    self.access_token_cache_key, (access_token, lifetime - ttl), timeout=ttl
+                )
+                self._remember_token(access_token, ttl)
+                logger.info("Access token refreshed and cached successfully")
+                return access_token
             else:
-                logger.error(f"Token refresh failed: {response.status_code} - {response.text}")
+                logger.error("No access_token in response")
                 return None
-
-        except Exception as e:
-            logger.error(f"Exception getting access token: {e}")
+        else:
+            logger.error(
+                f"Token refresh failed: {response.status_code} - "
+                f"{self._response_snippet(response, 1024)}"
+            )
             return None
 
+    @staticmethod
+    def _token_lifetime(expires_in):
+        """Token lifetime in seconds: expires_in if usable, else the 2h default."""
+        try:
+            return int(expires_in)
+        except (TypeError, ValueError):
+            return _TOKEN_LIFETIME_SECONDS
+
+    @classmethod
+    def _token_ttl(cls, expires_in):
+        """
+        Cache lifetime for a fresh token, honouring expires_in if given.
+        Keeps 10m of slack, or half the lifetime for short tokens, so the
+        TTL never decreases as expires_in grows.
+        """
+        lifetime = cls._token_lifetime(expires_in)
+        ttl = max(lifetime - _TOKEN_EXPIRY_SLACK_SECONDS, lifetime // 2)
+        return max(min(_TOKEN_TTL_SECONDS, ttl), 1)
+
     # ------------------------------------------------------------------
     #  Text / phone sanitization helpers
     # ------------------------------------------------------------------
@@ -99,27 +342,28 @@ class KhazenlyService:
             return ""
 
         sanitized = str(text).strip()
-        sanitized = unicodedata.normalize('NFC', sanitized)
 
-        # Remove zero-width and bidi control characters
-        _invisible = re.compile(
-            r'[\u200b-\u200f\u202a-\u202e\u2060-\u2064\ufeff\ufffe]+'
-        )
-        sanitized = _invisible.sub('', sanitized)
+        # Common case (SKUs, customer IDs, "Egypt"): short printable ASCII
+        # with single spaces is already clean
+        if (len(sanitized) <= max_length and sanitized.isascii()
+                and sanitized.isprintable() and '  ' not in sanitized):
+            return sanitized
+
+        # NFC, zero-width / bidi controls and lone surrogates (the only thing
+        # a str can hold that won't encode as UTF-8) only concern non-ASCII
+        if not sanitized.isascii():
+            sanitized = unicodedata.normalize('NFC', sanitized)
+            sanitized = _INVISIBLE_RE.sub('', sanitized)
+            if _SURROGATE_RE.search(sanitized):
+                sanitized = _SURROGATE_RE.sub('', sanitized)
+                logger.warning("Encoding issues in %s, removed problematic characters", field_name)
 
         # Remove control chars except basic whitespace
-        sanitized = "".join(ch for ch in sanitized if ord(ch) >= 32 or ch in "\n\r\t")
-        sanitized = re.sub(r'\s+', ' ', sanitized).strip()
-
-        # Safe UTF-8 round-trip
-        try:
-            sanitized = sanitized.encode('utf-8').decode('utf-8')
-        except (UnicodeEncodeError, UnicodeDecodeError):
-            sanitized = sanitized.encode('utf-8', 'ignore').decode('utf-8')
-            logger.warning(f"Encoding issues in {field_name}, removed problematic characters")
+        sanitized = sanitized.translate(_CONTROL_CHARS)
+        sanitized = _WHITESPACE_RE.sub(' ', sanitized).strip()
 
         if len(sanitized) > max_length:
-            logger.warning(f"Truncating {field_name} from {len(sanitized)} to {max_length} chars")
+            logger.warning("Truncating %s from %d to %d chars", field_name, len(sanitized), max_length)
             sanitized = sanitized[:max_length].strip()
             last_space = sanitized.rfind(' ')
             if last_space > max_length * 0.8:
@@ -136,7 +380,14 @@ class KhazenlyService:
         if not phone:
             return ""
 
-        phone_str = re.sub(r'[^\d+]', '', str(phone).strip())
+        # The junk pattern already drops whitespace, so no strip() is needed;
+        # model fields are str already, str() only covers ints from callers.
+        if not isinstance(phone, str):
+            phone = str(phone)
+        if phone.isascii():
+            phone_str = phone.translate(_PHONE_ASCII_JUNK)
+        else:
+            phone_str = _PHONE_JUNK_RE.sub('', phone)
 
         # Strip country code prefix
         if phone_str.startswith('+2'):
@@ -144,20 +395,10 @@ class KhazenlyService:
         elif phone_str.startswith('2') and len(phone_str) > 11:
             phone_str = phone_str[1:]
 
-        valid_prefixes = ('010', '011', '012', '015')
-        if not phone_str.startswith(valid_prefixes):
-            logger.warning(f"Phone '{phone}' invalid prefix - rejected")
-            return ""
-
-        if len(phone_str) < 11:
-            logger.warning(f"Phone '{phone}' too short ({len(phone_str)} digits) - rejected")
-            return ""
-
-        if len(phone_str) > 11:
-            phone_str = phone_str[:11]
-
-        if not phone_str.isdigit():
-            logger.warning(f"Phone '{phone_str}' contains non-digits - rejected")
+        # Extra trailing digits are dropped, as before
+        phone_str = phone_str[:11]
+        if not _EGY_MOBILE_RE.fullmatch(phone_str):
+            logger.warning("Phone '%s' is not a valid mobile number - rejected", phone)
             return ""
 
         return phone_str
@@ -167,12 +408,13 @@ class KhazenlyService:
         """Remove emojis / special chars from product name for Khazenly."""
         if not text:
             return ""
-        sanitized = str(text).strip()
-        sanitized = re.sub(
-            r'[^\w\s\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF'
-            r'\uFB50-\uFDFF\uFE70-\uFEFF.,\-()]+', ' ', sanitized
-        )
-        return re.sub(r'\s+', ' ', sanitized).strip()
+        return _ITEM_NAME_JUNK_RE.sub(' ', str(text)).strip()
+
+    @staticmethod
+    def strict_clean(text):
+        """Keep only word chars, Arabic letters and basic punctuation."""
+        clean = unicodedata.normalize('NFC', str(text))
+        return _STRICT_JUNK_RE.sub(' ', clean).strip()
 
     def sanitize_for_khazenly(self, text, max_length=None):
         """Convenience wrapper kept for backward-compat."""
@@ -229,18 +471,12 @@ class KhazenlyService:
                 issues.append(f"Customer name too long ({len(customer_name)}/100 chars)")
 
             primary_tel = customer.get('Tel', '')
-            if primary_tel:
-                if len(primary_tel) > 20:
-                    issues.append(f"Primary phone too long ({len(primary_tel)}/20)")
-                if not primary_tel.startswith(('010', '011', '012', '015')):
-                    issues.append(f"Primary phone invalid prefix: '{primary_tel}'")
+            if primary_tel and not _EGY_MOBILE_RE.fullmatch(primary_tel):
+                issues.append(f"Primary phone invalid: '{primary_tel}'")
 
             secondary_tel = customer.get('secondaryTel', '') or customer.get('SecondaryTel', '')
-            if secondary_tel:
-                if len(secondary_tel) > 20:
-                    issues.append(f"Secondary phone too long ({len(secondary_tel)}/20)")
-                if not secondary_tel.startswith(('010', '011', '012', '015')):
-                    issues.append(f"Secondary phone invalid prefix: '{secondary_tel}'")
+            if secondary_tel and not _EGY_MOBILE_RE.fullmatch(secondary_tel):
+                issues.append(f"Secondary phone invalid: '{secondary_tel}'")
 
             address1 = customer.get('Address1', '')
             if address1 and len(address1) > 255:
@@ -264,50 +500,38 @@ class KhazenlyService:
 
             # City must be in Khazenly's supported list
             if city:
-                if city not in self._supported_cities():
-                    available = ', '.join(self._supported_cities()[:8]) + '...'
+                if city not in _SUPPORTED_CITY_SET:
+                    available = ', '.join(_SUPPORTED_CITIES[:8]) + '...'
                     issues.append(f"City '{city}' not supported. Available: {available}")
 
-            if issues:
-                summary = f"Validation failed ({len(issues)} issues): " + "; ".join(issues[:3])
-                if len(issues) > 3:
-                    summary += f" ... and {len(issues) - 3} more"
-                return {'valid': False, 'issues': issues, 'summary': summary}
-
-            return {'valid': True, 'issues': [], 'summary': 'Validation passed'}
+            return self._validation_result(issues)
 
         except Exception as e:
             logger.error(f"Error validating order data: {e}")
             return {'valid': False, 'issues': [f'Validation error: {e}']}
 
+    @staticmethod
+    def _validation_result(issues):
+        """Wrap a list of issues in the validate_order_data result shape."""
+        if issues:
+            summary = f"Validation failed ({len(issues)} issues): " + "; ".join(issues[:3])
+            if len(issues) > 3:
+                summary += f" ... and {len(issues) - 3} more"
+            return {'valid': False, 'issues': issues, 'summary': summary}
+
+        return {'valid': True, 'issues': [], 'summary': 'Validation passed'}
+
     # ------------------------------------------------------------------
     #  Static data
     # ------------------------------------------------------------------
 
     @staticmethod
     def _supported_cities():
-        return [
-            'Alexandria', 'Assiut', 'Aswan', 'Bani-Sweif', 'Behera', 'Cairo',
-            'Dakahleya', 'Damietta', 'Fayoum', 'Giza', 'Hurghada', 'Ismailia',
-            'Luxor', 'Mahalla', 'Mansoura', 'Marsa Matrouh', 'Menya', 'Monefeya',
-            'North Coast', 'Port-Said', 'Qalyubia', 'Qena', 'Red Sea', 'Sharkeya',
-            'Sohag', 'Suez', 'Tanta', 'Zagazig', 'Gharbeya', 'Kafr El Sheikh',
-            'Al-Wadi Al-Gadid', 'Sharm El Sheikh', 'North Sinai', 'South Sinai',
-        ]
+        return _SUPPORTED_CITIES
 
     @staticmethod
     def _government_to_city():
-        return {
-            '1': 'Cairo', '2': 'Alexandria', '3': 'Kafr El Sheikh',
-            '4': 'Dakahleya', '5': 'Sharkeya', '6': 'Gharbeya',
-            '7': 'Monefeya', '8': 'Qalyubia', '9': 'Giza',
-            '10': 'Bani-Sweif', '11': 'Fayoum', '12': 'Menya',
-            '13': 'Assiut', '14': 'Sohag', '15': 'Qena',
-            '16': 'Luxor', '17': 'Aswan', '18': 'Red Sea',
-            '19': 'Behera', '20': 'Ismailia', '21': 'Suez',
-            '22': 'Port-Said', '23': 'Damietta', '24': 'Marsa Matrouh',
-            '25': 'Al-Wadi Al-Gadid', '26': 'North Sinai', '27': 'South Sinai',
-        }
+        return _GOVERNMENT_TO_CITY
 
     # ------------------------------------------------------------------
     #  Internal: send order to Khazenly API (single attempt)
@@ -317,16 +541,87 @@ class KhazenlyService:
         """
         Make a single POST to CreateOrder.
         Returns (response_obj | None, error_string | None).
+        Short-circuits while the breaker is open.
         """
+        if self._circuit_open():
+            return None, _CIRCUIT_OPEN_ERROR
+
         try:
-            response = requests.post(api_url, json=order_data, headers=headers, timeout=60)
-            return response, None
+            response = _session.post(api_url, json=order_data, headers=headers,
+                                     timeout=_CREATE_ORDER_TIMEOUT)
         except requests.exceptions.Timeout:
-            return None, 'Khazenly API request timed out (60s). Please try again later.'
+            error = 'Khazenly API request timed out (60s). Please try again later.'
         except requests.exceptions.ConnectionError as exc:
-            return None, f'Could not connect to Khazenly API: {exc}'
+            error = f'Could not connect to Khazenly API: {exc}'
         except requests.exceptions.RequestException as exc:
-            return None, f'Network error: {exc}'
+            error = f'Network error: {exc}'
+        else:
+            self._record_response(response)
+            return response, None
+
+        self._record_failure()
+        return None, error
+
+    def _circuit_open(self):
+        return bool(cache.get(self.circuit_open_cache_key))
+
+    def _record_response(self, response):
+        """A 5xx counts towards the breaker; anything else resets the count."""
+        if response.status_code < 500:
+            cache.delete(self.failure_count_cache_key)
+        else:
+            self._record_failure()
+
+    def _record_failure(self):
+        """Count a failed Khazenly call; open the breaker at the threshold."""
+        cache.add(self.failure_count_cache_key, 0, timeout=_CIRCUIT_FAILURE_WINDOW_SECONDS)
+        try:
+            failures = cache.incr(self.failure_count_cache_key)
+        except ValueError:
+            # Counter expired between add and incr
+            failures = 1
+            cache.set(self.failure_count_cache_key, failures,
+                      timeout=_CIRCUIT_FAILURE_WINDOW_SECONDS)
+
+        if failures >= _CIRCUIT_FAILURE_THRESHOLD:
+            logger.error(
+                f"Khazenly failed {failures} times in a row - "
+                f"pausing calls for {_CIRCUIT_RESET_SECONDS}s"
+            )
+            cache.set(self.circuit_open_cache_key, True, timeout=_CIRCUIT_RESET_SECONDS)
+            cache.delete(self.failure_count_cache_key)
+
+    @staticmethod
+    def _response_snippet(response, limit):
+        """
+        First `limit` bytes of the body as text, for logs / error messages.
+        Slicing the raw bytes avoids decoding (and charset-sniffing) a
+        potentially huge HTML error page just to keep a few hundred chars;
+        the charset the response declares is still honoured.
+        """
+        snippet = response.content[:limit]
+        try:
+            return snippet.decode(response.encoding or 'utf-8', errors='replace')
+        except LookupError:
+            # Unknown charset name in the Content-Type header
+            return snippet.decode('utf-8', errors='replace')
+
+    @staticmethod
+    def _auth_headers(access_token):
+        """
+        Per-call headers.  Accept is a session default and json= sets
+        Content-Type, so only the (rotating) bearer token varies.
+        """
+        return {'Authorization': f'Bearer {access_token}'}
+
+    @staticmethod
+    def _with_customer(order_data, **changes):
+        """
+        Copy of the payload with a fresh Customer section.
+        Retries only ever touch Customer, so Order and lineItems are shared
+        with the original instead of being deep-copied on every attempt.
+        """
+        return {**order_data, 'Customer': {**order_data['Customer'], **changes}}
 
     def _parse_success(self, response_data):
         """Extract order info from a successful Khazenly response."""
@@ -362,21 +657,40 @@ class KhazenlyService:
            still fails the admin must contact Khazenly support.
         4. **Pre-flight duplicate check** - query Khazenly for existing order
            by orderNumber before creating, to avoid double-sends.
+        5. **Pre-flight before the validation verdict** - the payload is
+           built locally first, but a pill that already exists in Khazenly
+           returns already_exists even if its local data no longer validates.
+           A pill with no line items fails before any Khazenly call.
         """
         try:
-            logger.info(f"Creating Khazenly order for pill {pill.pill_number}")
+            logger.info("Creating Khazenly order for pill %s", pill.pill_number)
+
+            # 1. Validate pill has address
+            try:
+                address = pill.pilladdress
+            except ObjectDoesNotExist:
+                return {'success': False, 'error': 'Pill address information missing'}
 
-            # 1. Access token
+            # 2-7. Build the payload (pure data, no HTTP), validating as we go
+            order_data, issues = self._build_order_payload(pill, address)
+            if order_data is None:
+                # Nothing to send, whatever Khazenly holds - fail before any HTTP
+                return {'success': False, 'error': f'No line items for pill {pill.pill_number}'}
+
+            # Don't spend a token fetch and a GetOrder on an upstream that is
+            # known to be down - the send would be refused anyway.
+            if self._circuit_open():
+                return {'success': False, 'error': _CIRCUIT_OPEN_ERROR}
+
+            # 8. Access token
             access_token = self.get_access_token()
             if not access_token:
                 return {'success': False, 'error': 'Failed to get Khazenly access token'}
 
-            # 2. Validate pill has address
-            if not hasattr(pill, 'pilladdress'):
-                return {'success': False, 'error': 'Pill address information missing'}
-            address = pill.pilladdress
-
-            # 3. Pre-flight: check if this order already exists in Khazenly
+            # 9. Pre-flight: check if this order already exists in Khazenly.
+            # Runs before the validation verdict, so an order that was sent
+            # earlier is reported as such even if the local data has since
+            # stopped validating.
             existing = self.check_order_exists(pill.pill_number)
             if existing and existing.get('salesOrderNumber'):
                 logger.info(
@@ -394,153 +708,37 @@ class KhazenlyService:
                     },
                 }
 
-            # 4. Prepare line items
-            line_items = []
-            total_product_price = 0
-            pill_items = pill.items.all()
-            logger.info(f"Processing pill {pill.pill_number}: {len(pill_items)} items")
-
-            for item in pill_items:
-                product = item.product
-                original_price = float(product.price) if product.price else 0
-                discounted_price = float(product.discounted_price())
-                item_discount = original_price - discounted_price
-                total_product_price += discounted_price * item.quantity
-
-                description = self.sanitize_item_name(product.name)
-                parts = []
-                if item.size:
-                    parts.append(f"Size: {item.size}")
-                if item.color:
-                    parts.append(f"Color: {self.sanitize_item_name(item.color.name)}")
-                if parts:
-                    description += f" ({', '.join(parts)})"
-                description = description[:150]
-
-                line_items.append({
-                    "SKU": product.product_number or f"PROD-{product.id}",
-                    "ItemName": description,
-                    "Price": discounted_price,
-                    "Quantity": item.quantity,
-                    "DiscountAmount": item_discount if item_discount > 0 else None,
-                    "ItemId": str(item.id),
-                })
-
-            if not line_items:
-                return {'success': False, 'error': f'No line items for pill {pill.pill_number}'}
-
-            # 5. Calculate amounts
-            shipping_fees = float(pill.shipping_price())
-            gift_discount = float(pill.calculate_gift_discount())
-            coupon_discount = float(pill.coupon_discount) if pill.coupon_discount else 0
-            total_discount = gift_discount + coupon_discount
-            total_amount = total_product_price + shipping_fees - total_discount
-
-            # 6. Phone numbers
-            primary_tel = self.validate_phone(address.phone) if address.phone else ""
-
-            # Secondary phone priority: user.phone -> user.phone2 -> user.parent_phone
-            # Skip any phone identical to primary.
-            secondary_tel = ""
-            primary_normalized = primary_tel  # already clean 11 digits or ""
-
-            for attr in ('phone', 'phone2', 'parent_phone'):
-                candidate_raw = getattr(pill.user, attr, None)
-                if not candidate_raw:
-                    continue
-                candidate = self.validate_phone(candidate_raw)
-                if candidate and candidate != primary_normalized:
-                    secondary_tel = candidate
-                    logger.info(f"Using user.{attr} as secondary phone: {secondary_tel}")
-                    break
-
-            # 7. Resolve city from government code
-            khazenly_city = ""
-            if hasattr(address, 'government') and address.government:
-                khazenly_city = self._government_to_city().get(address.government, '')
-                if not khazenly_city:
-                    from products.models import GOVERNMENT_CHOICES
-                    khazenly_city = dict(GOVERNMENT_CHOICES).get(address.government, 'Cairo')
-            if not khazenly_city:
-                khazenly_city = "Cairo"
-
-            if khazenly_city not in self._supported_cities():
-                logger.warning(f"City '{khazenly_city}' not supported - falling back to Cairo")
-                khazenly_city = "Cairo"
-
-            # 8. Build customer ID  (PREFIX-phone)
-            customer_id = self.build_customer_id(primary_tel)
-
-            # 9. Build order payload
-            # IMPORTANT: orderId is ALWAYS pill_number (deterministic, no timestamp)
-            order_data = {
-                "Order": {
-                    "orderId": str(pill.pill_number),
-                    "orderNumber": pill.pill_number,
-                    "storeName": self.store_name,
-                    "totalAmount": total_amount,
-                    "shippingFees": shipping_fees,
-                    "discountAmount": total_discount,
-                    "taxAmount": 0,
-                    "invoiceTotalAmount": total_amount,
-                    "weight": 0,
-                    "noOfBoxes": 1,
-                    "paymentMethod": "Pre-Paid",
-                    "paymentStatus": "paid",
-                    "storeCurrency": "EGP",
-                    "isPickedByMerchant": False,
-                    "merchantAWB": "",
-                    "merchantCourier": "",
-                    "merchantAwbDocument": "",
-                    "additionalNotes": (
-                        f"Prepaid order - pill {pill.pill_number} - "
-                        f"{len(line_items)} items - Payment via website"
-                    ),
-                },
-                "Customer": {
-                    "customerName": self.sanitize_text(
-                        address.name or f"Customer {pill.user.username}", 50, "customerName"
-                    ),
-                    "customerId": customer_id,
-                    "Tel": primary_tel,
-                    "secondaryTel": secondary_tel,
-                    "Address1": self.sanitize_text(
-                        f"{address.city} - {address.address}" if address.city and address.address
-                        else (address.city or address.address or 'Address not provided'),
-                        100, "address1"
-                    ),
-                    "Address2": "",
-                    "Address3": "",
-                    "City": khazenly_city,
-                    "Country": "Egypt",
-                },
-                "lineItems": line_items,
-            }
-
-            # 10. Pre-send validation
-            validation = self.validate_order_data(order_data)
+            # 10. Pre-send validation.  Deliberately after the pre-flight:
+            # returning the validation failure first would report an order
+            # that Khazenly already holds (e.g. one whose 100%-discounted item
+            # now fails "missing price") as invalid instead of already_exists.
+            validation = self._validation_result(issues)
             if not validation['valid']:
                 summary = validation.get('summary', 'Validation failed')
                 issues_list = validation.get('issues', [])
-                admin_msg = (
-                    f"KHAZENLY VALIDATION FAILED\n\n{summary}\n\n"
-                    + "\n".join(f"- {i}" for i in issues_list[:10])
-                    + f"\n\nPill #{pill.pill_number}"
-                )
+                lines = ["KHAZENLY VALIDATION FAILED", "", summary, ""]
+                lines.extend(f"- {i}" for i in issues_list[:10])
+                if len(issues_list) > 10:
+                    lines.append(f"... and {len(issues_list) - 10} more")
+                lines += ["", f"Pill #{pill.pill_number}"]
+                admin_msg = "\n".join(lines)
                 return {'success': False, 'error': admin_msg}
 
             # 11. Send to Khazenly
-            api_url = f"{self.base_url}/services/apexrest/api/CreateOrder"
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json',
-                'Accept': 'application/json',
-            }
-
-            logger.info(f"Sending order to Khazenly: orderId={order_data['Order']['orderId']}")
-            logger.info(f"Customer: {order_data['Customer']['customerName']}, "
-                        f"Tel: {order_data['Customer']['Tel']}, "
-                        f"customerId: {order_data['Customer'].get('customerId')}")
+            api_url = self.create_order_url
+            headers = self._auth_headers(access_token)
+
+            if logger.isEnabledFor(logging.DEBUG):
+                customer = order_data['Customer']
+                logger.debug("create_order payload summary: %s", {
+                    'orderId': order_data['Order']['orderId'],
+                    'items': len(order_data['lineItems']),
+                    'customerName': customer['customerName'],
+                    'customerId': customer['customerId'],
+                    'Tel': customer['Tel'],
+                    'secondaryTel': customer['secondaryTel'],
+                    'City': customer['City'],
+                })
 
             response, net_error = self._send_order_request(api_url, headers, order_data)
             if net_error:
@@ -552,11 +750,186 @@ class KhazenlyService:
             )
 
         except Exception as e:
-            logger.error(f"Exception creating Khazenly order: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
+            logger.exception("Exception creating Khazenly order")
             return {'success': False, 'error': str(e)}
 
+    # ------------------------------------------------------------------
+    #  Payload building
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _pill_items_with_discounts(pill):
+        """
+        Pill items with product/color joined (only the columns the payload
+        uses) and the best active product- and category-level discount
+        percentages annotated, matching Product.get_current_discount().
+        """
+        now = timezone.now()
+        active = Discount.objects.filter(
+            is_active=True, discount_start__lte=now, discount_end__gte=now,
+        ).order_by('-discount')
+
+        def best(**target):
+            return Subquery(active.filter(**target).values('discount')[:1])
+
+        return pill.items.select_related('product', 'color').only(
+            'id', 'quantity', 'size',
+            'product__id', 'product__name', 'product__price', 'product__product_number',
+            'color__name',
+        ).annotate(
+            active_product_discount=best(product=OuterRef('product')),
+            active_category_discount=best(category=OuterRef('product__category')),
+        )
+
+    def _build_line_item(self, item):
+        """Build one CreateOrder line item from an annotated pill item."""
+        product = item.product
+        original_price = float(product.price) if product.price else 0
+        percents = [
+            p for p in (item.active_product_discount, item.active_category_discount)
+            if p is not None
+        ]
+        discounted_price = original_price * (1 - max(percents) / 100) if percents else original_price
+        item_discount = original_price - discounted_price
+
+        description = self.sanitize_item_name(product.name)
+        parts = []
+        if item.size:
+            parts.append(f"Size: {item.size}")
+        if item.color:
+            parts.append(f"Color: {self.sanitize_item_name(item.color.name)}")
+        if parts:
+            description += f" ({', '.join(parts)})"
+
+        return {
+            "SKU": product.product_number or f"PROD-{product.id}",
+            "ItemName": description[:150],
+            "Price": discounted_price,
+            "Quantity": item.quantity,
+            "DiscountAmount": item_discount if item_discount > 0 else None,
+            "ItemId": str(item.id),
+        }
+
+    def _build_order_payload(self, pill, address):
+        """
+        Build the CreateOrder payload for a pill.
+        Pure data preparation (DB reads only, no Khazenly calls).
+
+        Returns (order_data, issues).  Only the checks the builder cannot
+        already guarantee are collected into issues - lengths and the city
+        are enforced by sanitize_text / the fallback to Cairo.  order_data
+        is None if the pill has no line items.
+        """
+        issues = []
+
+        # 2. Prepare line items
+        # One query for items + product/category/color + active discounts,
+        # instead of per-item queries through product.discounted_price().
+        line_items = [self._build_line_item(item)
+                      for item in self._pill_items_with_discounts(pill)]
+        total_product_price = sum(li["Price"] * li["Quantity"] for li in line_items)
+
+        for n, li in enumerate(line_items, 1):
+            if not li["Quantity"]:
+                issues.append(f"Product {n} missing quantity")
+            if not li["Price"]:
+                issues.append(f"Product {n} missing price")
+
+        if not line_items:
+            return None, ["No products found in order"]
+
+        # 3. Calculate amounts
+        shipping_fees = float(pill.shipping_price())
+        gift_discount = float(pill.calculate_gift_discount())
+        coupon_discount = float(pill.coupon_discount) if pill.coupon_discount else 0
+        total_discount = gift_discount + coupon_discount
+        total_amount = total_product_price + shipping_fees - total_discount
+
+        # 4. Phone numbers
+        primary_tel = self.validate_phone(address.phone) if address.phone else ""
+
+        # Secondary phone priority: user.phone -> user.phone2 -> user.parent_phone
+        # Skip any phone identical to primary (already clean 11 digits or "").
+        user = pill.user
+        secondary_tel = ""
+
+        for candidate_raw in (user.phone, user.phone2, user.parent_phone):
+            if not candidate_raw:
+                continue
+            candidate = self.validate_phone(candidate_raw)
+            if candidate and candidate != primary_tel:
+                secondary_tel = candidate
+                break
+
+        # 5. Resolve city from government code
+        khazenly_city = ""
+        if address.government:
+            khazenly_city = _GOVERNMENT_TO_CITY.get(address.government, '')
+            if not khazenly_city:
+                khazenly_city = _GOVERNMENT_NAMES.get(address.government, 'Cairo')
+        if not khazenly_city:
+            khazenly_city = "Cairo"
+
+        if khazenly_city not in _SUPPORTED_CITY_SET:
+            logger.warning("City '%s' not supported - falling back to Cairo", khazenly_city)
+            khazenly_city = "Cairo"
+
+        # 6. Build customer ID  (PREFIX-phone)
+        customer_id = self.build_customer_id(primary_tel)
+
+        # 7. Build order payload
+        # IMPORTANT: orderId is ALWAYS pill_number (deterministic, no timestamp)
+        order = {
+            "orderId": str(pill.pill_number),
+            "orderNumber": pill.pill_number,
+            "storeName": self.store_name,
+            "totalAmount": total_amount,
+            "shippingFees": shipping_fees,
+            "discountAmount": total_discount,
+            "taxAmount": 0,
+            "invoiceTotalAmount": total_amount,
+            "weight": 0,
+            "noOfBoxes": 1,
+            "paymentMethod": "Pre-Paid",
+            "paymentStatus": "paid",
+            "storeCurrency": "EGP",
+            "isPickedByMerchant": False,
+            "merchantAWB": "",
+            "merchantCourier": "",
+            "merchantAwbDocument": "",
+            "additionalNotes": (
+                f"Prepaid order - pill {pill.pill_number} - "
+                f"{len(line_items)} items - Payment via website"
+            ),
+        }
+        customer = {
+            "customerName": self.sanitize_text(
+                address.name or f"Customer {user.username}", 50, "customerName"
+            ),
+            "customerId": customer_id,
+            "Tel": primary_tel,
+            "secondaryTel": secondary_tel,
+            "Address1": self.sanitize_text(
+                f"{address.city} - {address.address}" if address.city and address.address
+                else (address.city or address.address or 'Address not provided'),
+                100, "address1"
+            ),
+            "Address2": "",
+            "Address3": "",
+            "City": khazenly_city,
+            "Country": "Egypt",
+        }
+        order_data = {"Order": order, "Customer": customer, "lineItems": line_items}
+
+        for field in ('orderId', 'storeName', 'totalAmount'):
+            if not order[field]:
+                issues.append(f"Missing required order field: {field}")
+        for field in ('customerName', 'Tel', 'Address1'):
+            if not customer[field]:
+                issues.append(f"Missing required customer field: {field}")
+
+        return order_data, issues
+
     # ------------------------------------------------------------------
     #  Response handling (extracted for clarity)
     # ------------------------------------------------------------------
@@ -566,7 +939,9 @@ class KhazenlyService:
         Process the Khazenly CreateOrder response.
         Handles success, known error codes, and retry logic.
         """
-        logger.info(f"Khazenly response: {response.status_code} - {response.text[:500]}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Khazenly response: %s - %s",
+                         response.status_code, self._response_snippet(response, 500))
 
         # ----- HTTP 200 (could still be a logical error) ------------------
         if response.status_code == 200:
@@ -597,7 +972,7 @@ class KhazenlyService:
                 error_data.get('error', f'HTTP {response.status_code}'))
             )
         except Exception:
-            error_msg = response.text[:300] if response.text else f'HTTP {response.status_code}'
+            error_msg = self._response_snippet(response, 300) or f'HTTP {response.status_code}'
 
         # Check for DUPLICATES_DETECTED at HTTP level
         if "DUPLICATES_DETECTED" in str(error_msg) or "Consignee Code already exists" in str(error_msg):
@@ -608,30 +983,25 @@ class KhazenlyService:
     def _handle_logical_error(self, error_msg, order_data, api_url, headers, pill):
         """Handle a logical (resultCode != 0) error from Khazenly."""
 
-        lower = error_msg.lower()
-
-        # ---- Corrupted customer data / wrong code ----
-        if any(kw in lower for kw in ('corrupted customer data', 'wrong code', 'corpted')):
-            return self._handle_corrupted_customer(
-                error_msg, order_data, api_url, headers, pill
-            )
+        found = {m.lastgroup for m in _LOGICAL_ERROR_RE.finditer(error_msg)}
 
-        # ---- DUPLICATES_DETECTED ----
-        if "DUPLICATES_DETECTED" in error_msg or "Consignee Code already exists" in error_msg:
-            return self._handle_duplicate_customer(
-                error_msg, order_data, api_url, headers, pill
-            )
+        for kind, handler_name in _LOGICAL_ERROR_HANDLERS.items():
+            if kind in found:
+                return getattr(self, handler_name)(
+                    error_msg, order_data, api_url, headers, pill
+                )
 
-        # ---- STRING_TOO_LONG ----
-        if "STRING_TOO_LONG" in error_msg:
-            if "City" in error_msg:
-                return {'success': False, 'error': 'City field too long for Khazenly.'}
-            return {'success': False, 'error': 'A field is too long for Khazenly. Shorten address details.'}
+        return {'success': False, 'error': f'Khazenly error: {error_msg}'}
 
-        if "REQUIRED_FIELD_MISSING" in error_msg:
-            return {'success': False, 'error': 'Required field missing. Check address info is complete.'}
+    def _handle_string_too_long(self, error_msg, order_data, api_url, headers, pill):
+        """STRING_TOO_LONG - tell the admin which field to shorten."""
+        if "City" in error_msg:
+            return {'success': False, 'error': 'City field too long for Khazenly.'}
+        return {'success': False, 'error': 'A field is too long for Khazenly. Shorten address details.'}
 
-        return {'success': False, 'error': f'Khazenly error: {error_msg}'}
+    def _handle_required_field_missing(self, error_msg, order_data, api_url, headers, pill):
+        """REQUIRED_FIELD_MISSING - the address info is incomplete."""
+        return {'success': False, 'error': 'Required field missing. Check address info is complete.'}
 
     # ------------------------------------------------------------------
     #  Corrupted-customer retry (NO phone swap)
@@ -657,26 +1027,21 @@ class KhazenlyService:
         """
         logger.warning(f"Corrupted customer for pill {pill.pill_number} - retrying with cleaned data")
 
-        retry_data = copy.deepcopy(order_data)
+        retry_data = self._with_customer(order_data, secondaryTel="")
+        retry_customer = retry_data['Customer']
 
         # Strip secondaryTel completely (both casing variants)
-        retry_data['Customer']['secondaryTel'] = ""
-        retry_data['Customer'].pop('SecondaryTel', None)
+        retry_customer.pop('SecondaryTel', None)
 
         # Extra-strict sanitization
         for field in ('customerName', 'Address1'):
-            val = retry_data['Customer'].get(field, '')
+            val = retry_customer.get(field, '')
             if val:
-                clean = unicodedata.normalize('NFC', str(val).strip())
-                clean = re.sub(
-                    r'[^\w\s\u0600-\u06FF\u0750-\u077F.,\-()]+', ' ', clean
-                )
-                clean = re.sub(r'\s+', ' ', clean).strip()
-                retry_data['Customer'][field] = clean
+                retry_customer[field] = self.strict_clean(val)
 
         # ----- Retry 1: cleaned data, same customerId ---------------------
-        logger.info(f"Retry 1 - Tel: {retry_data['Customer']['Tel']}, "
-                    f"secondaryTel cleared, customerId: {retry_data['Customer'].get('customerId')}")
+        logger.debug("Retry 1 - Tel: %s, secondaryTel cleared, customerId: %s",
+                     retry_customer['Tel'], retry_customer.get('customerId'))
 
         response, net_err = self._send_order_request(api_url, headers, retry_data)
         if net_err:
@@ -702,8 +1067,7 @@ class KhazenlyService:
             f"Retry 1 failed for pill {pill.pill_number} - "
             f"trying with customerId=null to bypass corrupted record"
         )
-        retry_data2 = copy.deepcopy(retry_data)
-        retry_data2['Customer']['customerId'] = None
+        retry_data2 = self._with_customer(retry_data, customerId=None)
 
         response2, net_err2 = self._send_order_request(api_url, headers, retry_data2)
         if net_err2:
@@ -781,8 +1145,7 @@ class KhazenlyService:
 
         # Step 2: Retry with customerId=null  (let Khazenly auto-match)
         logger.info("Retrying with customerId=null to let Khazenly auto-match")
-        retry_data = copy.deepcopy(order_data)
-        retry_data['Customer']['customerId'] = None
+        retry_data = self._with_customer(order_data, customerId=None)
 
         response, net_err = self._send_order_request(api_url, headers, retry_data)
         if net_err:
@@ -821,28 +1184,33 @@ class KhazenlyService:
     def check_order_exists(self, order_number):
         """
         Check if an order already exists in Khazenly by orderNumber.
-        Returns the order dict if found, None otherwise.
+        Returns the order dict if found, None otherwise (including while
+        the circuit breaker is open).
         """
         try:
+            if self._circuit_open():
+                return None
+
             access_token = self.get_access_token()
             if not access_token:
                 return None
 
-            query_url = f"{self.base_url}/services/apexrest/api/GetOrder"
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json',
-                'Accept': 'application/json',
-            }
+            headers = self._auth_headers(access_token)
             params = {'orderNumber': order_number}
 
-            logger.info(f"Checking if order {order_number} exists in Khazenly...")
-            response = requests.get(query_url, headers=headers, params=params, timeout=30)
+            logger.debug("Checking if order %s exists in Khazenly", order_number)
+            try:
+                response = _session.get(self.get_order_url, headers=headers, params=params,
+                                        timeout=_DEFAULT_TIMEOUT)
+            except requests.exceptions.RequestException:
+                self._record_failure()
+                raise
+            self._record_response(response)
 
             if response.status_code == 200:
                 data = response.json()
                 if data.get('resultCode') == 0 and data.get('order', {}).get('id'):
-                    logger.info(f"Order {order_number} exists in Khazenly")
+                    logger.info("Order %s exists in Khazenly", order_number)
                     return data.get('order')
 
             return None
@@ -856,25 +1224,52 @@ class KhazenlyService:
     # ------------------------------------------------------------------
 
     def get_order_status(self, sales_order_number):
-        """Get order status from Khazenly."""
+        """
+        Get order status from Khazenly.
+        Successful lookups are cached briefly so polling doesn't hit the API
+        on every call; errors are never cached.  A failing cache backend
+        only costs the cache - the lookup falls through to the live request.
+        """
+        cache_key = f'khazenly_order_status_{sales_order_number}'
         try:
+            cached = cache.get(cache_key)
+        except Exception as e:
+            logger.warning(f"Order status cache unavailable: {e}")
+            cached = None
+        if cached is not None:
+            return cached
+
+        try:
+            if self._circuit_open():
+                return {'success': False, 'error': _CIRCUIT_OPEN_ERROR}
+
             access_token = self.get_access_token()
             if not access_token:
                 return {'success': False, 'error': 'Failed to get access token'}
 
-            status_url = (
-                f"{self.base_url}/services/apexrest/"
-                f"ExternalIntegrationWebService/orders/{sales_order_number}"
-            )
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Accept': 'application/json',
-            }
+            headers = self._auth_headers(access_token)
 
-            response = requests.get(status_url, headers=headers, timeout=30)
+            logger.debug("Checking order status for %s", sales_order_number)
+            try:
+                response = _session.get(
+                    f"{self.order_status_url_prefix}{sales_order_number}",
+                    headers=headers, timeout=_DEFAULT_TIMEOUT,
+                )
+            except requests.exceptions.RequestException:
+                self._record_failure()
+                raise
+            self._record_response(response)
             if response.status_code == 200:
-                return {'success': True, 'data': response.json()}
-            return {'success': False, 'error': f'HTTP {response.status_code}: {response.text}'}
+                result = {'success': True, 'data': response.json()}
+                try:
+                    cache.set(cache_key, result, timeout=_ORDER_STATUS_CACHE_SECONDS)
+                except Exception as e:
+                    logger.warning(f"Could not cache order status: {e}")
+                return result
+            return {
+                'success': False,
+                'error': f'HTTP {response.status_code}: {self._response_snippet(response, 1024)}',
+            }
 
         except Exception as e:
             logger.error(f"Exception getting order status: {e}")
@@ -884,69 +1279,100 @@ class KhazenlyService:
     #  Diagnostics
     # ------------------------------------------------------------------
 
-    def diagnose_customer_data(self, pill):
-        """Diagnose customer data issues that might cause Khazenly API errors."""
+    def diagnose_customer_data(self, pill, fast=False):
+        """
+        Diagnose customer data issues that might cause Khazenly API errors.
+        With fast=True the per-field 'details' are skipped and the diagnosis
+        stops at the first issue - enough for a pass/fail pre-check.
+        """
         try:
-            logger.info(f"DIAGNOSING CUSTOMER DATA for Pill {pill.pill_number}")
+            logger.debug("Diagnosing customer data for pill %s", pill.pill_number)
 
-            if not hasattr(pill, 'pilladdress'):
-                return {'issues': ['Missing address'], 'details': 'No pilladdress'}
+            try:
+                address = pill.pilladdress
+            except ObjectDoesNotExist:
+                return {
+                    'success': True,
+                    'has_issues': True,
+                    'issues': ['Missing address'],
+                    'details': 'No pilladdress',
+                }
 
-            address = pill.pilladdress
             issues = []
-            details = {}
 
             # Name
             name = address.name or f"Customer {pill.user.username}"
-            details['customerName'] = {
-                'value': name, 'length': len(name),
-                'has_special': bool(re.search(r'[^\w\s\-.,()]+', name)),
-            }
-            if len(name) > 50:
-                issues.append(f'Customer name too long ({len(name)}/50)')
+            name_len = len(name)
+            if name_len > 50:
+                issues.append(f'Customer name too long ({name_len}/50)')
+                if fast:
+                    return self._diagnosis_result(issues, None)
 
             # Phones
-            for label, raw in [
-                ('primary', getattr(address, 'phone', '')),
-                ('user_phone', getattr(pill.user, 'phone', '')),
-                ('user_phone2', getattr(pill.user, 'phone2', '')),
-                ('parent_phone', getattr(pill.user, 'parent_phone', '')),
-            ]:
+            user = pill.user
+            phone_details = {}
+            for label, raw in (
+                ('primary', address.phone),
+                ('user_phone', user.phone),
+                ('user_phone2', user.phone2),
+                ('parent_phone', user.parent_phone),
+            ):
                 if not raw:
                     continue
                 validated = self.validate_phone(raw)
-                details[f'{label}_phone'] = {
-                    'original': raw, 'validated': validated,
-                    'valid': bool(validated),
+                is_valid = bool(validated)
+                phone_details[f'{label}_phone'] = {
+                    'original': raw, 'validated': validated, 'valid': is_valid,
                 }
-                if raw and not validated:
+                if not is_valid:
                     issues.append(f'{label} phone invalid: {raw}')
+                    if fast:
+                        return self._diagnosis_result(issues, None)
 
             # Address
             addr_text = address.address or ""
-            details['address'] = {'value': addr_text, 'length': len(addr_text)}
-            if len(addr_text) > 100:
-                issues.append(f'Address too long ({len(addr_text)}/100)')
+            addr_len = len(addr_text)
+            if addr_len > 100:
+                issues.append(f'Address too long ({addr_len}/100)')
+                if fast:
+                    return self._diagnosis_result(issues, None)
 
             # City
-            gov = getattr(address, 'government', '')
-            city = self._government_to_city().get(gov, '') if gov else ''
-            details['city'] = {'government_code': gov, 'mapped': city}
-            if city and city not in self._supported_cities():
+            gov = address.government
+            city = _GOVERNMENT_TO_CITY.get(gov, '') if gov else ''
+            if city and city not in _SUPPORTED_CITY_SET:
                 issues.append(f"City '{city}' not in Khazenly list")
 
-            logger.info(f"Diagnosis: {len(issues)} issues found")
-            return {
-                'success': True,
-                'has_issues': len(issues) > 0,
-                'issues': issues,
-                'details': details,
+            details = None if fast else {
+                'customerName': {
+                    'value': name, 'length': name_len,
+                    'has_special': bool(_SPECIAL_CHARS_RE.search(name)),
+                },
+                **phone_details,
+                'address': {'value': addr_text, 'length': addr_len},
+                'city': {'government_code': gov, 'mapped': city},
             }
+            return self._diagnosis_result(issues, details)
 
         except Exception as e:
             logger.error(f"Error diagnosing customer data: {e}")
             return {'success': False, 'error': str(e)}
 
+    @staticmethod
+    def _diagnosis_result(issues, details):
+        logger.info("Diagnosis: %d issues found", len(issues))
+        if issues and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Diagnosis issues: %s", "; ".join(issues))
+        result = {
+            'success': True,
+            'has_issues': len(issues) > 0,
+            'issues': issues,
+        }
+        if details is not None:
+            result['details'] = details
+        return result
+
 
-# Global instance
-khazenly_service = KhazenlyService()
+# Global instance, created on first use so importing this module (e.g. from
+# management commands) doesn't read the Khazenly settings up front.
+khazenly_service = SimpleLazyObject(KhazenlyService)
@@ -16,14 +16,17 @@ Run with:
 
 import json
 import copy
+from datetime import timedelta
 from unittest.mock import patch, MagicMock, PropertyMock
+
+import requests
 from django.test import TestCase, TransactionTestCase, override_settings
 from django.core.cache import cache
 from django.utils import timezone
 
 from accounts.models import User
 from products.models import (
-    Product, Category, PillItem, Pill, PillAddress, Shipping, Color,
+    Product, Category, PillItem, Pill, PillAddress, Shipping, Color, Discount,
     GOVERNMENT_CHOICES,
 )
 from services.khazenly_service import KhazenlyService, khazenly_service
@@ -126,6 +129,8 @@ def _mock_response(status_code=200, json_data=None, text=""):
     resp = MagicMock()
     resp.status_code = status_code
     resp.text = text or json.dumps(json_data or {})
+    resp.content = resp.text.encode("utf-8")
+    resp.encoding = "utf-8"
     resp.json.return_value = json_data or {}
     return resp
 
@@ -160,7 +165,7 @@ class TestCustomerIdGeneration(TestCase):
 
     @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
     @patch("services.khazenly_service.KhazenlyService.check_order_exists", return_value=None)
-    @patch("services.khazenly_service.requests.post")
+    @patch("services.khazenly_service.requests.Session.post")
     def test_create_order_sends_customer_id(self, mock_post, mock_check, mock_token):
         """The order payload must include customerId=BOOKIFAY-{phone}."""
         user = _make_user()
@@ -202,7 +207,7 @@ class TestDeterministicOrderId(TestCase):
 
     @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
     @patch("services.khazenly_service.KhazenlyService.check_order_exists", return_value=None)
-    @patch("services.khazenly_service.requests.post")
+    @patch("services.khazenly_service.requests.Session.post")
     def test_order_id_is_pill_number(self, mock_post, mock_check, mock_token):
         """orderId must be pill_number exactly — no suffix, no timestamp."""
         user = _make_user()
@@ -220,7 +225,7 @@ class TestDeterministicOrderId(TestCase):
 
     @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
     @patch("services.khazenly_service.KhazenlyService.check_order_exists", return_value=None)
-    @patch("services.khazenly_service.requests.post")
+    @patch("services.khazenly_service.requests.Session.post")
     def test_retry_keeps_same_order_id(self, mock_post, mock_check, mock_token):
         """Even on DUPLICATES_DETECTED retry, orderId must stay the same."""
         user = _make_user()
@@ -254,7 +259,7 @@ class TestPreFlightDuplicateCheck(TestCase):
         self.svc = KhazenlyService()
 
     @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
-    @patch("services.khazenly_service.requests.post")
+    @patch("services.khazenly_service.requests.Session.post")
     @patch("services.khazenly_service.KhazenlyService.check_order_exists")
     def test_existing_order_returns_success_no_post(self, mock_check, mock_post, mock_token):
         """If check_order_exists finds the order, create_order should NOT call POST."""
@@ -291,7 +296,7 @@ class TestCorruptedCustomerRetry(TestCase):
 
     @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
     @patch("services.khazenly_service.KhazenlyService.check_order_exists", return_value=None)
-    @patch("services.khazenly_service.requests.post")
+    @patch("services.khazenly_service.requests.Session.post")
     def test_corrupted_retry_clears_secondary_tel(self, mock_post, mock_check, mock_token):
         """On corrupted error, retry should clear secondaryTel but keep primary phone."""
         user = _make_user(phone="01000003102", phone2="01555555555")
@@ -325,7 +330,7 @@ class TestCorruptedCustomerRetry(TestCase):
 
     @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
     @patch("services.khazenly_service.KhazenlyService.check_order_exists", return_value=None)
-    @patch("services.khazenly_service.requests.post")
+    @patch("services.khazenly_service.requests.Session.post")
     def test_corrupted_retry2_succeeds_with_null_customer_id(self, mock_post, mock_check, mock_token):
         """Retry 1 fails (corrupted), retry 2 with customerId=null succeeds."""
         user = _make_user(phone="01000003102", phone2="01555555555")
@@ -363,7 +368,7 @@ class TestCorruptedCustomerRetry(TestCase):
 
     @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
     @patch("services.khazenly_service.KhazenlyService.check_order_exists", return_value=None)
-    @patch("services.khazenly_service.requests.post")
+    @patch("services.khazenly_service.requests.Session.post")
     def test_corrupted_retry_fails_gives_clear_message(self, mock_post, mock_check, mock_token):
         """If all 3 attempts fail (corrupted), error message must mention contacting Khazenly support."""
         user = _make_user()
@@ -387,7 +392,7 @@ class TestCorruptedCustomerRetry(TestCase):
 
     @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
     @patch("services.khazenly_service.KhazenlyService.check_order_exists", return_value=None)
-    @patch("services.khazenly_service.requests.post")
+    @patch("services.khazenly_service.requests.Session.post")
     def test_no_phone_swap_on_any_error(self, mock_post, mock_check, mock_token):
         """
         The old code swapped primary/secondary phones on error.
@@ -422,6 +427,21 @@ class TestCorruptedCustomerRetry(TestCase):
         self.assertIsNone(retry2_payload["Customer"]["customerId"])
 
 
+    def test_retry_payload_does_not_mutate_original(self):
+        order = {
+            "Order": {"orderId": "1"},
+            "Customer": {"Tel": "01000003102", "secondaryTel": "01555555555", "customerId": "X"},
+            "lineItems": [{"SKU": "PROD-1"}],
+        }
+        retry = KhazenlyService._with_customer(order, secondaryTel="", customerId=None)
+
+        self.assertEqual(retry["Customer"]["secondaryTel"], "")
+        self.assertIsNone(retry["Customer"]["customerId"])
+        self.assertEqual(order["Customer"]["secondaryTel"], "01555555555")
+        self.assertEqual(order["Customer"]["customerId"], "X")
+        self.assertIs(retry["lineItems"], order["lineItems"])
+
+
 # =========================================================================
 #  5. DUPLICATE CUSTOMER HANDLER
 # =========================================================================
@@ -433,7 +453,7 @@ class TestDuplicateCustomerHandler(TestCase):
         self.svc = KhazenlyService()
 
     @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
-    @patch("services.khazenly_service.requests.post")
+    @patch("services.khazenly_service.requests.Session.post")
     @patch("services.khazenly_service.KhazenlyService.check_order_exists")
     def test_duplicate_detected_order_exists(self, mock_check, mock_post, mock_token):
         """
@@ -457,7 +477,7 @@ class TestDuplicateCustomerHandler(TestCase):
         self.assertTrue(result["data"].get("already_exists"))
 
     @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
-    @patch("services.khazenly_service.requests.post")
+    @patch("services.khazenly_service.requests.Session.post")
     @patch("services.khazenly_service.KhazenlyService.check_order_exists", return_value=None)
     def test_duplicate_detected_retry_with_null_customer_id(self, mock_check, mock_post, mock_token):
         """
@@ -495,7 +515,7 @@ class TestPaymentMethod(TestCase):
 
     @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
     @patch("services.khazenly_service.KhazenlyService.check_order_exists", return_value=None)
-    @patch("services.khazenly_service.requests.post")
+    @patch("services.khazenly_service.requests.Session.post")
     def test_payment_method_pre_paid(self, mock_post, mock_check, mock_token):
         user = _make_user()
         pill = _make_pill(user)
@@ -541,6 +561,13 @@ class TestPhoneValidation(TestCase):
     def test_none(self):
         self.assertEqual(KhazenlyService.validate_phone(None), "")
 
+    def test_punctuation_and_int_input(self):
+        self.assertEqual(KhazenlyService.validate_phone("(010)-0000-3102"), "01000003102")
+        self.assertEqual(KhazenlyService.validate_phone(1000003102), "")
+
+    def test_non_ascii_junk_is_stripped(self):
+        self.assertEqual(KhazenlyService.validate_phone("هاتف: 01000003102"), "01000003102")
+
 
 # =========================================================================
 #  8. TEXT SANITIZATION
@@ -561,6 +588,20 @@ class TestSanitization(TestCase):
         result = KhazenlyService.sanitize_text("اسراء محمد علي", 50, "test")
         self.assertEqual(result, "اسراء محمد علي")
 
+    def test_removes_control_chars(self):
+        result = KhazenlyService.sanitize_text("Ahmed\x00\x07 Ali\tSaid\x1f", 50, "test")
+        self.assertEqual(result, "Ahmed Ali Said")
+
+    def test_removes_lone_surrogates(self):
+        result = KhazenlyService.sanitize_text("اسراء\udc80 محمد", 50, "test")
+        self.assertEqual(result, "اسراء محمد")
+        result.encode("utf-8")
+
+    def test_clean_ascii_passes_through(self):
+        self.assertEqual(KhazenlyService.sanitize_text(" PROD-12 ", 50, "test"), "PROD-12")
+        self.assertEqual(KhazenlyService.sanitize_text("Ahmed   Ali", 50, "test"), "Ahmed Ali")
+        self.assertEqual(KhazenlyService.sanitize_text("Ahmed\tAli\x00", 50, "test"), "Ahmed Ali")
+
     def test_empty_returns_empty(self):
         self.assertEqual(KhazenlyService.sanitize_text("", 50, "test"), "")
         self.assertEqual(KhazenlyService.sanitize_text(None, 50, "test"), "")
@@ -571,6 +612,10 @@ class TestSanitization(TestCase):
         self.assertIn("كشكول", result)
         self.assertIn("أحياء", result)
 
+    def test_strict_clean_keeps_arabic_and_punctuation(self):
+        result = KhazenlyService.strict_clean("  شارع ١٥ — (وسط) ★ البلد, 3-A ")
+        self.assertEqual(result, "شارع ١٥ (وسط) البلد, 3-A")
+
 
 # =========================================================================
 #  9. ORDER VALIDATION
@@ -620,6 +665,17 @@ class TestOrderValidation(TestCase):
         self.assertFalse(result["valid"])
         self.assertTrue(any("not supported" in i for i in result["issues"]))
 
+    def test_malformed_phones_flagged_once(self):
+        order = self._valid_order()
+        order["Customer"]["Tel"] = "0100000310"
+        order["Customer"]["secondaryTel"] = "01300003102"
+        result = self.svc.validate_order_data(order)
+        self.assertFalse(result["valid"])
+        self.assertEqual(result["issues"], [
+            "Primary phone invalid: '0100000310'",
+            "Secondary phone invalid: '01300003102'",
+        ])
+
     def test_no_line_items(self):
         order = self._valid_order()
         order["lineItems"] = []
@@ -627,6 +683,60 @@ class TestOrderValidation(TestCase):
         self.assertFalse(result["valid"])
         self.assertTrue(any("No products" in i for i in result["issues"]))
 
+    @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
+    @patch("services.khazenly_service.KhazenlyService.check_order_exists", return_value=None)
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_build_flags_missing_tel_without_sending(self, mock_post, mock_check, mock_token):
+        """Issues collected while building the payload block the send."""
+        user = _make_user()
+        pill = _make_pill(user, address_phone="0999")
+
+        result = self.svc.create_order(pill)
+
+        self.assertFalse(result["success"])
+        self.assertIn("Missing required customer field: Tel", result["error"])
+        mock_check.assert_called_once_with(pill.pill_number)
+        mock_post.assert_not_called()
+
+    @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
+    @patch("services.khazenly_service.KhazenlyService.check_order_exists", return_value=None)
+    def test_no_line_items_fails_before_any_http(self, mock_check, mock_token):
+        pill = _make_pill(_make_user(), products=[])
+
+        result = self.svc.create_order(pill)
+
+        self.assertFalse(result["success"])
+        self.assertIn("No line items", result["error"])
+        mock_token.assert_not_called()
+        mock_check.assert_not_called()
+
+    @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_existing_order_wins_over_failed_validation(self, mock_post, mock_token):
+        """A pill already in Khazenly is reported as existing, not as invalid."""
+        pill = _make_pill(_make_user(), address_phone="0999")
+        existing = {"id": "a0X1", "salesOrderNumber": "SO-1", "orderNumber": pill.pill_number}
+
+        with patch.object(KhazenlyService, "check_order_exists", return_value=existing):
+            result = self.svc.create_order(pill)
+
+        self.assertTrue(result["success"])
+        self.assertTrue(result["data"]["already_exists"])
+        mock_post.assert_not_called()
+
+    @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
+    @patch("services.khazenly_service.KhazenlyService.check_order_exists", return_value=None)
+    def test_admin_message_counts_hidden_issues(self, mock_check, mock_token):
+        pill = _make_pill(_make_user())
+        issues = [f"Issue {n}" for n in range(1, 13)]
+
+        with patch.object(KhazenlyService, "_build_order_payload", return_value=({}, issues)):
+            error = self.svc.create_order(pill)["error"]
+
+        self.assertIn("- Issue 10", error)
+        self.assertNotIn("- Issue 11", error)
+        self.assertIn("... and 2 more", error)
+        self.assertTrue(error.endswith(f"Pill #{pill.pill_number}"))
 
 # =========================================================================
 #  10. MODEL-LEVEL LOCKING (_create_khazenly_order)
@@ -784,7 +894,7 @@ class TestSecondaryTelCasing(TestCase):
 
     @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
     @patch("services.khazenly_service.KhazenlyService.check_order_exists", return_value=None)
-    @patch("services.khazenly_service.requests.post")
+    @patch("services.khazenly_service.requests.Session.post")
     def test_secondary_tel_lowercase(self, mock_post, mock_check, mock_token):
         user = _make_user(phone="01000003102", phone2="01555666777")
         pill = _make_pill(user)
@@ -821,8 +931,8 @@ class TestEndToEndDuplicateScenario(TestCase):
         self.svc = KhazenlyService()
 
     @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
-    @patch("services.khazenly_service.requests.post")
-    @patch("services.khazenly_service.requests.get")
+    @patch("services.khazenly_service.requests.Session.post")
+    @patch("services.khazenly_service.requests.Session.get")
     def test_returning_customer_second_order(self, mock_get, mock_post, mock_token):
         """
         Scenario:
@@ -851,8 +961,8 @@ class TestEndToEndDuplicateScenario(TestCase):
         self.assertEqual(payload["Order"]["orderId"], str(pill.pill_number))
 
     @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
-    @patch("services.khazenly_service.requests.get")
-    @patch("services.khazenly_service.requests.post")
+    @patch("services.khazenly_service.requests.Session.get")
+    @patch("services.khazenly_service.requests.Session.post")
     def test_resend_same_order_detected(self, mock_post, mock_get, mock_token):
         """
         Scenario: Admin clicks "Send to Khazenly" again for the same pill.
@@ -899,3 +1009,507 @@ class TestGovernmentMapping(TestCase):
                 code, mapping,
                 f"GOVERNMENT_CHOICES code '{code}' ({display_name}) has no Khazenly mapping"
             )
+
+
+# =========================================================================
+#  15. LOGICAL ERROR DISPATCH
+# =========================================================================
+
+class TestLogicalErrorDispatch(TestCase):
+    """Verify resultCode != 0 messages are routed to the right handler."""
+
+    def setUp(self):
+        self.svc = KhazenlyService()
+
+    def _dispatch(self, error_msg):
+        return self.svc._handle_logical_error(error_msg, {}, "url", {}, MagicMock())
+
+    def test_string_too_long_city(self):
+        result = self._dispatch("STRING_TOO_LONG: City: data value too large")
+        self.assertEqual(result["error"], "City field too long for Khazenly.")
+
+    def test_required_field_missing(self):
+        result = self._dispatch("REQUIRED_FIELD_MISSING: [Tel]")
+        self.assertIn("Required field missing", result["error"])
+
+    @patch("services.khazenly_service.KhazenlyService._handle_corrupted_customer",
+           return_value={"success": False, "error": "corrupted"})
+    def test_corrupted_is_case_insensitive(self, mock_corrupted):
+        self._dispatch("Corrupted Customer Data - WRONG CODE")
+        mock_corrupted.assert_called_once()
+
+    @patch("services.khazenly_service.KhazenlyService._handle_duplicate_customer",
+           return_value={"success": False, "error": "duplicate"})
+    def test_priority_not_position_decides(self, mock_duplicate):
+        """A later, higher-priority marker wins over an earlier one."""
+        result = self._dispatch("STRING_TOO_LONG; DUPLICATES_DETECTED")
+        self.assertEqual(result["error"], "duplicate")
+
+    def test_unknown_error_passthrough(self):
+        result = self._dispatch("SOMETHING_ELSE")
+        self.assertEqual(result["error"], "Khazenly error: SOMETHING_ELSE")
+
+
+# =========================================================================
+#  16. ERROR BODY HANDLING
+# =========================================================================
+
+class TestResponseSnippet(TestCase):
+    """Error bodies are cut at the byte level before decoding."""
+
+    def test_snippet_truncates_and_tolerates_split_utf8(self):
+        resp = _mock_response(500, text="<html>" + "خطأ" * 500 + "</html>")
+        snippet = KhazenlyService._response_snippet(resp, 9)
+        self.assertTrue(snippet.startswith("<html>"))
+        self.assertLessEqual(len(snippet.encode("utf-8")), 12)
+
+    def test_snippet_honours_declared_charset(self):
+        resp = _mock_response(500)
+        resp.content = "Erreur: données invalides".encode("latin-1")
+        resp.encoding = "ISO-8859-1"
+        self.assertEqual(KhazenlyService._response_snippet(resp, 100), "Erreur: données invalides")
+
+        resp.encoding = None
+        resp.content = "خطأ".encode("utf-8")
+        self.assertEqual(KhazenlyService._response_snippet(resp, 100), "خطأ")
+
+        resp.encoding = "no-such-charset"
+        self.assertEqual(KhazenlyService._response_snippet(resp, 100), "خطأ")
+
+    @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
+    @patch("services.khazenly_service.KhazenlyService.check_order_exists", return_value=None)
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_non_json_http_error_uses_snippet(self, mock_post, mock_check, mock_token):
+        user = _make_user()
+        pill = _make_pill(user)
+
+        resp = _mock_response(502, text="<html>" + "x" * 5000 + "</html>")
+        resp.json.side_effect = ValueError("not json")
+        mock_post.return_value = resp
+
+        result = KhazenlyService().create_order(pill)
+
+        self.assertFalse(result["success"])
+        self.assertEqual(result["error"], "Khazenly API error: " + ("<html>" + "x" * 294))
+
+    @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
+    @patch("services.khazenly_service.requests.Session.get")
+    def test_order_status_error_is_capped(self, mock_get, mock_token):
+        mock_get.return_value = _mock_response(500, text="y" * 50000)
+
+        result = KhazenlyService().get_order_status("SO-1")
+
+        self.assertFalse(result["success"])
+        self.assertEqual(result["error"], "HTTP 500: " + "y" * 1024)
+
+
+# =========================================================================
+#  17. ACCESS TOKEN CACHING
+# =========================================================================
+
+class TestAccessTokenCaching(TestCase):
+    """Tokens are refreshed once and then served from memory / cache."""
+
+    def setUp(self):
+        cache.clear()
+        self.svc = KhazenlyService()
+
+    def tearDown(self):
+        cache.clear()
+
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_refresh_happens_once(self, mock_post):
+        mock_post.return_value = _mock_response(200, {"access_token": "tok-1"})
+
+        self.assertEqual(self.svc.get_access_token(), "tok-1")
+        self.assertEqual(self.svc.get_access_token(), "tok-1")
+
+        self.assertEqual(mock_post.call_count, 1)
+
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_new_instance_reuses_shared_cache(self, mock_post):
+        mock_post.return_value = _mock_response(200, {"access_token": "tok-2"})
+        self.svc.get_access_token()
+
+        self.assertEqual(KhazenlyService().get_access_token(), "tok-2")
+        self.assertEqual(mock_post.call_count, 1)
+
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_expired_memo_refreshes(self, mock_post):
+        mock_post.side_effect = [
+            _mock_response(200, {"access_token": "old"}),
+            _mock_response(200, {"access_token": "new"}),
+        ]
+        self.assertEqual(self.svc.get_access_token(), "old")
+
+        cache.clear()
+        self.svc._token_expires_at = 0.0
+
+        self.assertEqual(self.svc.get_access_token(), "new")
+
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_failed_refresh_returns_none(self, mock_post):
+        mock_post.return_value = _mock_response(401, {"error": "invalid_grant"})
+        self.assertIsNone(self.svc.get_access_token())
+
+    def test_token_ttl_honours_expires_in(self):
+        self.assertEqual(KhazenlyService._token_ttl(None), 6600)
+        self.assertEqual(KhazenlyService._token_ttl("1800"), 1200)
+        self.assertEqual(KhazenlyService._token_ttl(86400), 6600)
+        self.assertEqual(KhazenlyService._token_ttl(300), 150)
+
+    def test_reads_legacy_plain_token_entry(self):
+        cache.set(self.svc.access_token_cache_key, "legacy")
+        self.assertEqual(self.svc.get_access_token(), "legacy")
+
+    def test_token_ttl_is_monotonic(self):
+        self.assertEqual(KhazenlyService._token_ttl(600), 300)
+        self.assertEqual(KhazenlyService._token_ttl(601), 300)
+        self.assertEqual(KhazenlyService._token_ttl(1200), 600)
+        ttls = [KhazenlyService._token_ttl(n) for n in range(1, 8000)]
+        self.assertEqual(ttls, sorted(ttls))
+
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_short_token_memo_capped_by_slack(self, mock_post):
+        """A cached short-lived token is not trusted past its real expiry."""
+        mock_post.return_value = _mock_response(200, {"access_token": "short", "expires_in": 200})
+        self.svc.get_access_token()
+        self.assertEqual(cache.get(self.svc.access_token_cache_key), ("short", 100))
+
+        other = KhazenlyService()
+        with patch("services.khazenly_service.time.monotonic", return_value=1000.0):
+            self.assertEqual(other.get_access_token(), "short")
+        self.assertLessEqual(other._token_expires_at, 1000.0 + 100)
+
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_refresh_lock_released(self, mock_post):
+        mock_post.return_value = _mock_response(200, {"access_token": "tok-3"})
+        self.svc.get_access_token()
+        self.assertIsNone(cache.get(self.svc.refresh_lock_cache_key))
+
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_waits_for_other_worker_refresh(self, mock_post):
+        """If another worker holds the refresh lock, use the token it publishes."""
+        cache.set(self.svc.refresh_lock_cache_key, "1", timeout=30)
+
+        def publish(_seconds):
+            cache.set(self.svc.access_token_cache_key, ("from-other-worker", 600))
+
+        with patch("services.khazenly_service.time.sleep", side_effect=publish):
+            self.assertEqual(self.svc.get_access_token(), "from-other-worker")
+
+        mock_post.assert_not_called()
+
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_waiter_never_refreshes_without_the_lock(self, mock_post):
+        """A slow refresh elsewhere makes waiters give up, not stampede."""
+        cache.set(self.svc.refresh_lock_cache_key, "1", timeout=60)
+        clock = iter(range(0, 1000, 5))
+
+        with patch("services.khazenly_service.time.sleep"), \
+                patch("services.khazenly_service.time.monotonic", side_effect=lambda: next(clock)):
+            self.assertIsNone(self.svc.get_access_token())
+
+        mock_post.assert_not_called()
+
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_waiter_takes_over_released_lock(self, mock_post):
+        """If the refreshing worker fails and releases the lock, a waiter refreshes."""
+        mock_post.return_value = _mock_response(200, {"access_token": "tok-4"})
+        cache.set(self.svc.refresh_lock_cache_key, "1", timeout=60)
+
+        def release(_seconds):
+            cache.delete(self.svc.refresh_lock_cache_key)
+
+        with patch("services.khazenly_service.time.sleep", side_effect=release):
+            self.assertEqual(self.svc.get_access_token(), "tok-4")
+        self.assertEqual(mock_post.call_count, 1)
+
+    def test_token_post_retries_but_create_order_does_not(self):
+        from services.khazenly_service import _session, _token_session
+
+        token_retry = _token_session.get_adapter(self.svc.token_url).max_retries
+        order_retry = _session.get_adapter(self.svc.create_order_url).max_retries
+        self.assertTrue(token_retry.is_retry("POST", 503))
+        self.assertTrue(token_retry.is_retry("POST", 429))
+        self.assertFalse(order_retry.is_retry("POST", 503))
+
+    def test_token_retries_fit_inside_refresh_lock(self):
+        from services import khazenly_service as ks
+
+        retry = ks._token_session.get_adapter(self.svc.token_url).max_retries
+        self.assertEqual(retry.read, 0)
+        self.assertLess(ks._TOKEN_REFRESH_MAX_SECONDS, ks._TOKEN_REFRESH_LOCK_SECONDS)
+
+    def test_api_session_does_not_retry_read_timeouts(self):
+        from services.khazenly_service import _session
+
+        retry = _session.get_adapter(self.svc.get_order_url).max_retries
+        self.assertEqual(retry.read, 0)
+        self.assertEqual(retry.connect, 0)
+        self.assertTrue(retry.is_retry("GET", 503))
+
+    def test_constructing_service_leaves_sessions_untouched(self):
+        from services.khazenly_service import _session, _token_session
+
+        before = (dict(_session.adapters), dict(_token_session.adapters))
+        KhazenlyService()
+        self.assertEqual((dict(_session.adapters), dict(_token_session.adapters)), before)
+
+
+# =========================================================================
+#  18. LINE-ITEM DISCOUNTS
+# =========================================================================
+
+class TestLineItemDiscounts(TestCase):
+    """Annotated discounts must price items like Product.discounted_price()."""
+
+    def setUp(self):
+        self.svc = KhazenlyService()
+
+    def test_best_active_discount_applied(self):
+        now = timezone.now()
+        category = Category.objects.create(name="Biology")
+        product = _make_product(price=200.0, category=category)
+        window = dict(discount_start=now - timedelta(days=1),
+                      discount_end=now + timedelta(days=1))
+        Discount.objects.create(product=product, discount=10, **window)
+        Discount.objects.create(category=category, discount=25, **window)
+        Discount.objects.create(product=product, discount=50, is_active=False, **window)
+
+        pill = _make_pill(_make_user(), products=[product])
+        order_data, issues = self.svc._build_order_payload(pill, pill.pilladdress)
+
+        item = order_data["lineItems"][0]
+        self.assertEqual(item["Price"], float(product.discounted_price()))
+        self.assertEqual(item["Price"], 150.0)
+        self.assertEqual(item["DiscountAmount"], 50.0)
+        self.assertEqual(issues, [])
+
+    def test_items_loaded_in_one_query(self):
+        products = [_make_product(name=f"Book {i}", price=10.0 + i) for i in range(3)]
+        pill = _make_pill(_make_user(), products=products)
+
+        with self.assertNumQueries(1):
+            items = list(self.svc._pill_items_with_discounts(pill))
+            line_items = [self.svc._build_line_item(item) for item in items]
+
+        self.assertEqual(len(line_items), 3)
+
+    def test_no_discount_uses_list_price(self):
+        pill = _make_pill(_make_user(), products=[_make_product(price=80.0)])
+        order_data, _ = self.svc._build_order_payload(pill, pill.pilladdress)
+
+        item = order_data["lineItems"][0]
+        self.assertEqual(item["Price"], 80.0)
+        self.assertIsNone(item["DiscountAmount"])
+
+
+# =========================================================================
+#  19. CIRCUIT BREAKER
+# =========================================================================
+
+class TestCircuitBreaker(TestCase):
+    """Repeated Khazenly API failures pause calls to Khazenly."""
+
+    API_URL = "https://khazenly.test/services/apexrest/api/CreateOrder"
+
+    def setUp(self):
+        cache.clear()
+        self.svc = KhazenlyService()
+
+    def tearDown(self):
+        cache.clear()
+
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_opens_after_threshold(self, mock_post):
+        mock_post.side_effect = requests.exceptions.ConnectionError("down")
+
+        for _ in range(5):
+            self.svc._send_order_request(self.API_URL, {}, {})
+        self.assertEqual(mock_post.call_count, 5)
+
+        response, error = self.svc._send_order_request(self.API_URL, {}, {})
+        self.assertIsNone(response)
+        self.assertIn("temporarily unavailable", error)
+        self.assertEqual(mock_post.call_count, 5)
+
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_success_resets_failure_count(self, mock_post):
+        mock_post.side_effect = (
+            [_mock_response(503, text="busy")] * 4
+            + [_mock_response(200, FAKE_SUCCESS_RESPONSE)]
+            + [_mock_response(503, text="busy")] * 4
+        )
+
+        for _ in range(9):
+            response, error = self.svc._send_order_request(self.API_URL, {}, {})
+            self.assertIsNotNone(response)
+            self.assertIsNone(error)
+
+        self.assertIsNone(cache.get(self.svc.circuit_open_cache_key))
+
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_logical_errors_do_not_count(self, mock_post):
+        mock_post.return_value = _mock_response(200, FAKE_DUPLICATE_ERROR)
+
+        for _ in range(6):
+            self.svc._send_order_request(self.API_URL, {}, {})
+
+        self.assertEqual(mock_post.call_count, 6)
+        self.assertIsNone(cache.get(self.svc.circuit_open_cache_key))
+
+    @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
+    @patch("services.khazenly_service.requests.Session.get")
+    @patch("services.khazenly_service.requests.Session.post")
+    def test_open_breaker_skips_preflight(self, mock_post, mock_get, mock_token):
+        cache.set(self.svc.circuit_open_cache_key, True)
+        pill = _make_pill(_make_user())
+
+        result = self.svc.create_order(pill)
+
+        self.assertFalse(result["success"])
+        self.assertIn("temporarily unavailable", result["error"])
+        mock_token.assert_not_called()
+        mock_get.assert_not_called()
+        mock_post.assert_not_called()
+
+    @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
+    @patch("services.khazenly_service.requests.Session.get")
+    def test_get_failures_open_breaker(self, mock_get, mock_token):
+        mock_get.side_effect = requests.exceptions.ConnectionError("down")
+
+        for n in range(5):
+            self.assertIsNone(self.svc.check_order_exists(f"P{n}"))
+        self.assertTrue(cache.get(self.svc.circuit_open_cache_key))
+
+        result = self.svc.get_order_status("SO-1")
+        self.assertFalse(result["success"])
+        self.assertIn("temporarily unavailable", result["error"])
+        self.assertEqual(mock_get.call_count, 5)
+
+    @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
+    @patch("services.khazenly_service.requests.Session.get")
+    def test_status_5xx_counts_towards_breaker(self, mock_get, mock_token):
+        mock_get.return_value = _mock_response(503, text="busy")
+        for _ in range(5):
+            self.svc.get_order_status("SO-1")
+        self.assertTrue(cache.get(self.svc.circuit_open_cache_key))
+
+
+# =========================================================================
+#  20. ORDER STATUS CACHING
+# =========================================================================
+
+class TestOrderStatusCaching(TestCase):
+    """Successful status lookups are served from cache; errors are not."""
+
+    def setUp(self):
+        cache.clear()
+        self.svc = KhazenlyService()
+
+    def tearDown(self):
+        cache.clear()
+
+    @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
+    @patch("services.khazenly_service.requests.Session.get")
+    def test_success_is_cached(self, mock_get, mock_token):
+        mock_get.return_value = _mock_response(200, {"status": "Shipped"})
+
+        first = self.svc.get_order_status("SO-1")
+        second = self.svc.get_order_status("SO-1")
+
+        self.assertEqual(first, second)
+        self.assertEqual(second["data"], {"status": "Shipped"})
+        mock_get.assert_called_once()
+
+    @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
+    @patch("services.khazenly_service.requests.Session.get")
+    def test_errors_are_not_cached(self, mock_get, mock_token):
+        mock_get.return_value = _mock_response(503, text="busy")
+
+        self.svc.get_order_status("SO-2")
+        self.svc.get_order_status("SO-2")
+
+        self.assertEqual(mock_get.call_count, 2)
+
+    @patch("services.khazenly_service.KhazenlyService.get_access_token", return_value="fake-token")
+    @patch("services.khazenly_service.requests.Session.get")
+    def test_cache_outage_falls_through_to_live_lookup(self, mock_get, mock_token):
+        mock_get.return_value = _mock_response(200, {"status": "Shipped"})
+        real_get, real_set = cache.get, cache.set
+
+        def flaky(real):
+            def call(key, *args, **kwargs):
+                if key.startswith("khazenly_order_status_"):
+                    raise ConnectionError("cache down")
+                return real(key, *args, **kwargs)
+            return call
+
+        with patch.object(cache, "get", side_effect=flaky(real_get)), \
+                patch.object(cache, "set", side_effect=flaky(real_set)):
+            result = self.svc.get_order_status("SO-3")
+
+        self.assertEqual(result, {"success": True, "data": {"status": "Shipped"}})
+
+
+# =========================================================================
+#  21. CUSTOMER DATA DIAGNOSIS
+# =========================================================================
+
+class TestDiagnoseCustomerData(TestCase):
+    """Full vs fast (pass/fail) diagnosis."""
+
+    def setUp(self):
+        self.svc = KhazenlyService()
+
+    def test_full_diagnosis_reports_all_issues_with_details(self):
+        user = _make_user(phone="0999", phone2="0888")
+        pill = _make_pill(user, address_phone="01000003102")
+
+        result = self.svc.diagnose_customer_data(pill)
+
+        self.assertTrue(result["has_issues"])
+        self.assertEqual(len(result["issues"]), 2)
+        self.assertIn("primary_phone", result["details"])
+
+    def test_fast_diagnosis_stops_at_first_issue(self):
+        user = _make_user(phone="0999", phone2="0888")
+        pill = _make_pill(user, address_phone="01000003102")
+
+        result = self.svc.diagnose_customer_data(pill, fast=True)
+
+        self.assertTrue(result["has_issues"])
+        self.assertEqual(result["issues"], ["user_phone phone invalid: 0999"])
+        self.assertNotIn("details", result)
+
+    def test_missing_address_returns_before_field_checks(self):
+        pill = _make_pill(_make_user())
+        pill.pilladdress.delete()
+        pill = Pill.objects.get(pk=pill.pk)
+
+        with patch.object(KhazenlyService, "validate_phone") as mock_validate:
+            result = self.svc.diagnose_customer_data(pill)
+
+        self.assertTrue(result["has_issues"])
+        self.assertEqual(result["issues"], ["Missing address"])
+        mock_validate.assert_not_called()
+
+    def test_fast_diagnosis_clean_pill(self):
+        pill = _make_pill(_make_user())
+        result = self.svc.diagnose_customer_data(pill, fast=True)
+        self.assertFalse(result["has_issues"])
+
+
+# =========================================================================
+#  22. LAZY SINGLETON
+# =========================================================================
+
+class TestLazySingleton(TestCase):
+    """The module-level instance is built on first use and then reused."""
+
+    def test_proxies_a_single_service(self):
+        self.assertIsInstance(khazenly_service, KhazenlyService)
+        first = khazenly_service._wrapped
+        khazenly_service.build_customer_id("01000003102")
+        self.assertIs(khazenly_service._wrapped, first)